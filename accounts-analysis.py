@@ -3,17 +3,21 @@
 
 import csv
 import datetime
+import functools
+import os
 import re
 import sqlite3
 import sys
+import time
 import configparser
+from collections import defaultdict
 
-import dateutil
-import dateutil.relativedelta
 import calendar
 
 import matplotlib.dates as mdates
+from matplotlib.collections import LineCollection
 import matplotlib.pyplot as plt
+import numpy as np
 from ofxparse import OfxParser
 
 MONTHS_IN_YEAR = 12
@@ -23,105 +27,138 @@ IMPORT_FLAG = "--import"
 DRY_RUN_FLAG = "--dry-run"
 DEBUG_FLAG = "--debug"
 CSV_OUTPUT_FLAG = "--csv-output"
+SAVE_PLOTS_FLAG = "--save-plots"
+PLOTS_DIRECTORY = "plots"
 CURRENCY = "€"
+SECONDS_IN_DAY = 86400
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+AMOUNT_SEPARATORS = str.maketrans({',': ' ', '.': ','})
+DECIMAL_SEPARATORS = str.maketrans({',': '.', '\xa0': None})
+SQL_PARAMETERS_CHUNK_SIZE = 500
+PATTERN_LAST_BALANCE = re.compile(r'Solde au ([0-3][0-9]\/[0-1][0-9]\/[1-2][0-9]{3}) ([\d+\xa0]*\d+,\d\d) \x80')
+PATTERN_OPERATION = re.compile(r'[0-3][0-9]\/[0-1][0-9]\/[1-2][0-9]{3}')
 
 config = configparser.RawConfigParser()
 
 
 class Operation:
+    __slots__ = ('id', 'date', 'date_epoch', 'label', 'value')
+
     def __init__(self, operation_id, date, label, amount):
         self.id = operation_id
-        self.date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        if isinstance(date, datetime.datetime) and (date.hour or date.minute or date.second or date.microsecond):
+            date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        self.date = date
+        self.date_epoch = to_epoch(date)
         self.label = label
         self.value = amount
 
     def debug(self, csv_output_mode: bool):
         separator = ";" if csv_output_mode else " "
-        return self.id + separator + str(self.date) + separator + "{:>8}".format(str(self.value)) + separator + "\"" + self.label + "\""
+        return f'{self.id}{separator}{self.date}{separator}{self.value!s:>8}{separator}"{self.label}"'
 
 
 class AccountStatement:
     def __init__(self, account_id):
         self.account_id = account_id
-        self.operations = {}
+        self.operations = defaultdict(list)
         self.last_date = None
         self.last_balance = None
 
     def add(self, operation):
-        if operation.date not in self.operations:
-            self.operations[operation.date] = []
         self.operations[operation.date].append(operation)
 
+
+class AccountHistory:
+    def __init__(self, account_id, ordinals, amounts):
+        self.account_id = account_id
+        self.ordinals = ordinals
+        self.amounts = amounts
+        self.last_date = None
+        self.last_balance = None
+        days, counts = np.unique(ordinals, return_counts=True)
+        self.counts = dict(zip(days.tolist(), counts.tolist()))
+
     def get_date_boundaries(self):
-        min_date = None
-        max_date = None
-        if len(self.operations) > 0:
-            operations_dates = list(self.operations.keys())
-            if len(operations_dates) > 0:
-                min_date = operations_dates[len(operations_dates) - 1]
-                max_date = operations_dates[0]
-        return min_date, max_date
-
-    def operations_count(self, date):
-        if len(self.operations) > 0 and date in self.operations:
-            return len(self.operations[date])
-        else:
-            return 0
+        if len(self.ordinals) == 0:
+            return None, None
+        return (datetime.datetime.fromordinal(int(self.ordinals.min())),
+                datetime.datetime.fromordinal(int(self.ordinals.max())))
+
+    def operations_arrays(self):
+        return self.ordinals, self.amounts
+
+    def operations_count(self, ordinal):
+        return self.counts.get(ordinal, 0)
 
 
 def parse_double(ch):
-    return float(ch.replace(',', '.').replace('\xa0', '')) if len(ch) > 0 else 0.0
+    return float(ch.translate(DECIMAL_SEPARATORS)) if ch else 0.0
+
 
+def parse_date(ch):
+    # dd/mm/yyyy, sliced by hand: strptime re-parses its format on every call
+    return datetime.date(int(ch[6:10]), int(ch[3:5]), int(ch[0:2]))
 
+
+def to_epoch(date):
+    # local midnight, as the DATE_EPOCH values already stored with strftime('%s')
+    return int(time.mktime(date.timetuple()))
+
+
+def to_datetime64(ordinals):
+    return (ordinals - EPOCH_ORDINAL).astype('datetime64[D]')
+
+
+@functools.lru_cache(maxsize=None)
 def get_account_name(account_id):
-    account_name = ""
-    try:
-        account_name = config.get('Accounts', str(account_id))
-    except Exception as ex:
-        print("Failed to retrieve the name of account " + str(account_id), str(ex))
-    finally:
-        return account_name if account_name else ""
+    return config.get('Accounts', str(account_id), fallback='')
 
 
+@functools.lru_cache(maxsize=None)
 def is_savings_account(account_id):
-    is_savings_account_param = False
     try:
-        is_savings_account_param = config.getboolean('Savings accounts', str(account_id))
-    except Exception as ex:
-        print("Failed to retrieve the name of account " + str(account_id), str(ex))
-    finally:
-        return is_savings_account_param if is_savings_account_param else False
+        return config.getboolean('Savings accounts', str(account_id), fallback=False)
+    except ValueError as ex:
+        print("Invalid savings flag for account " + str(account_id), str(ex))
+        return False
 
 
-def analyse_operations(statements: AccountStatement, connection, debug_mode: bool):
-    if len(statements.operations) > 0:
-        (balance_over_time, min_date, max_date,
+def analyse_operations(statements: AccountHistory, cur, debug_mode: bool, plots_dir: str = None):
+    if len(statements.ordinals) > 0:
+        (ordinals, balances, min_date, max_date,
          min_balance, min_balance_date,
-         max_balance, max_balance_date) = compute_balance_evolution(statements, connection, debug_mode)
-        draw_balance_evolution(statements.account_id, balance_over_time, min_date, max_date,
-                               min_balance, min_balance_date, max_balance, max_balance_date)
+         max_balance, max_balance_date) = compute_balance_evolution(statements, cur, debug_mode)
+        draw_balance_evolution(statements.account_id, ordinals, balances, min_date, max_date,
+                               min_balance, min_balance_date, max_balance, max_balance_date, plots_dir)
         if is_savings_account(statements.account_id):
-            balance_derivative = compute_savings_derivative(balance_over_time)
-            draw_savings_derivative(statements.account_id, balance_derivative)
-        balance_compared = compute_balance_compared(balance_over_time, statements.last_date)
-        draw_balance_comparison(statements.account_id, balance_compared)
+            balance_derivative = compute_savings_derivative(ordinals, balances)
+            draw_savings_derivative(statements.account_id, balance_derivative, plots_dir)
+        balance_compared = compute_balance_compared(ordinals, balances, statements.last_date)
+        draw_balance_comparison(statements.account_id, balance_compared, plots_dir)
 
 
 def format_amount(value):
-    return "{:,.2f}".format(value).replace(',', ' ').replace('.', ',') + " " + CURRENCY
+    return "{:,.2f}".format(value).translate(AMOUNT_SEPARATORS) + " " + CURRENCY
 
 
-def draw_balance_evolution(account_id, balance, min_date, max_date,
-                           min_balance, min_balance_date, max_balance, max_balance_date):
+def show_figure(fig, account_id, plot_name: str, plots_dir: str):
+    if plots_dir:
+        fig.savefig(f"{plots_dir}/account_{account_id}_{plot_name}.png")
+    else:
+        plt.show()
+    plt.close(fig)
+
 
-    last_balance = balance[next(iter(balance))]
+def draw_balance_evolution(account_id, ordinals, balances, min_date, max_date,
+                           min_balance, min_balance_date, max_balance, max_balance_date, plots_dir: str = None):
+
+    last_balance = float(balances[-1])
     offset = (max_balance - min_balance) * 0.7 / 100.0
 
     fig, axes = plt.subplots()
     fig.set_figwidth(20)
-    lists = sorted(balance.items())
-    x, y = zip(*lists)
-    axes.plot(x, y, color="mediumseagreen")
+    axes.plot(to_datetime64(ordinals), balances, color="mediumseagreen")
     axes.xaxis.set_major_locator(mdates.MonthLocator())
     for label in axes.get_xticklabels(which='major'):
         label.set(rotation=30, horizontalalignment='right')
@@ -138,31 +175,25 @@ def draw_balance_evolution(account_id, balance, min_date, max_date,
     plt.plot(max_date, last_balance, marker='x', color='black')
     plt.text(max_date, last_balance + offset, " " + format_amount(last_balance), color="black",
              verticalalignment='top')
-    plt.show()
+    show_figure(fig, account_id, "evolution", plots_dir)
 
 
-def last_non_none(lst):
-    i = len(lst) - 1
-    for item in reversed(lst):
-        if item is not None:
-            return i, item
-        i = i-1
-    return None, None
+def last_non_nan(values):
+    indexes = np.flatnonzero(~np.isnan(values))
+    if len(indexes) == 0:
+        return None, None
+    return int(indexes[-1]), float(values[indexes[-1]])
 
 
-def count_non_none(lst):
-    return sum(1 for item in lst if item is not None)
+def count_non_nan(values):
+    return int(np.count_nonzero(~np.isnan(values)))
 
 
 # Multi-Month Daily Bank Balance Trend Graph
 # comparing daily bank balances across multiple months
 def stats_same_day(balance_compared, day):
-    values_same_day = list(map(lambda balance_for_month: balance_for_month[day], balance_compared))
-    filtered_values_same_day = list(filter(lambda v: v is not None, values_same_day))
-    mean_value_same_day = sum(filtered_values_same_day) / len(filtered_values_same_day)
-    min_value_same_day = min(filtered_values_same_day)
-    max_value_same_day = max(filtered_values_same_day)
-    return min_value_same_day, max_value_same_day, mean_value_same_day
+    values_same_day = balance_compared[:, day]
+    return np.nanmin(values_same_day), np.nanmax(values_same_day), np.nanmean(values_same_day)
 
 
 def spot_value(x, y, marker, marker_color, text_color, label, h_alignment, plt, v_alignment='baseline'):
@@ -172,17 +203,16 @@ def spot_value(x, y, marker, marker_color, text_color, label, h_alignment, plt,
              color=text_color, horizontalalignment=h_alignment, verticalalignment=v_alignment)
 
 
-def draw_savings_derivative(account_id, savings_derivative):
+def draw_savings_derivative(account_id, savings_derivative, plots_dir: str = None):
     fig, axes = plt.subplots()
     fig.set_figwidth(20)
     lists = sorted(savings_derivative.items())
-    timestamps = list(savings_derivative.keys())
-    min_date = timestamps[0].replace(day=1)
-    max_date = timestamps[len(timestamps)-1]
-    max_date = max_date.replace(day=1) + dateutil.relativedelta.relativedelta(months=1)
+    min_date = min(savings_derivative).replace(day=1)
+    max_date = first_day_of_next_month(max(savings_derivative))
 
     x, y = zip(*lists)
-    savings_color = [{p<0: 'red', 0<=p<=2: 'orange', p>2: 'green'}[True] for p in y]
+    savings = np.asarray(y)
+    savings_color = np.where(savings < 0, 'red', np.where(savings <= 2, 'orange', 'green')).tolist()
     axes.bar(x, y, width=8.0, color=savings_color)
     axes.set_title("Epargne par mois - " + get_account_name(account_id) + " (" + str(account_id) + ")")
     axes.xaxis.set_major_locator(mdates.MonthLocator())
@@ -194,23 +224,24 @@ def draw_savings_derivative(account_id, savings_derivative):
         color = "green" if savings_derivative[item] > 0 else "red" if savings_derivative[item] < 0 else "black"
         vertical_alignment = "bottom" if savings_derivative[item] >= 0 else "top"
         spot_value(item, savings_derivative[item], "", color, color, label, "center", plt, vertical_alignment)
-    plt.show()
+    show_figure(fig, account_id, "savings", plots_dir)
 
 
-def draw_balance_comparison(account_id, balance_compared):
+def draw_balance_comparison(account_id, balance_compared, plots_dir: str = None):
     min_grey_intensity = 0.85
     max_grey_intensity = 0.35
     a = (max_grey_intensity - min_grey_intensity) / (len(balance_compared) - 1)
     fig, axes = plt.subplots()
     fig.set_figwidth(20)
-    for month_age in reversed(range(0, len(balance_compared))):
-        if month_age == 0:
-            color = "red"
-        else:
-            color_intensity = max_grey_intensity - month_age * a
-            color = (color_intensity, color_intensity, color_intensity)
-        if month_age < len(balance_compared):
-            plt.plot(range(1, len(balance_compared[month_age])), balance_compared[month_age][1:], color=color)
+    days = np.arange(1, DAYS_IN_MONTH + 1)
+    previous_balances = []
+    previous_colors = []
+    for month_age in reversed(range(1, len(balance_compared))):
+        color_intensity = max_grey_intensity - month_age * a
+        previous_balances.append(np.column_stack((days, balance_compared[month_age][1:])))
+        previous_colors.append((color_intensity, color_intensity, color_intensity))
+    axes.add_collection(LineCollection(previous_balances, colors=previous_colors))
+    plt.plot(days, balance_compared[0][1:], color="red")
     plt.hlines(y=0, xmin=1, xmax=31, colors='grey', linestyles='--')
     axes.xaxis.set_major_locator(mdates.WeekdayLocator(byweekday=(0, 1, 2, 3, 4, 5, 6)))
     axes.xaxis.set_minor_locator(mdates.DayLocator())
@@ -218,8 +249,8 @@ def draw_balance_comparison(account_id, balance_compared):
     axes.set_title("Comparaison du solde - " + get_account_name(account_id) + " (" + str(account_id) + ")")
     axes.set_ylabel(r'Solde')
 
-    last_month = 0 if count_non_none(balance_compared[0]) >= 1 else 1
-    last_day, last_balance = last_non_none(balance_compared[last_month])
+    last_month = 0 if count_non_nan(balance_compared[0]) >= 1 else 1
+    last_day, last_balance = last_non_nan(balance_compared[last_month])
 
     spot_value(last_day, last_balance, "x", "red", "red", "", "left", plt, "bottom")
 
@@ -229,80 +260,96 @@ def draw_balance_comparison(account_id, balance_compared):
     spot_value(last_day, max_value_same_day, "+", "grey", "darkgrey", "max: ", "right", plt, "bottom")
     spot_value(last_day, mean_value_same_day, "+", "grey", "darkgrey", "moy: ", "right", plt, "bottom")
 
-    plt.show()
+    show_figure(fig, account_id, "comparison", plots_dir)
 
 
-def compute_balance_evolution(account_statement: AccountStatement, connection, debug_mode: bool):
+def compute_balance_evolution(account_statement: AccountHistory, cur, debug_mode: bool):
     min_date, max_date = account_statement.get_date_boundaries()
-    balance_over_time = {}
-    current_date = account_statement.last_date
-    current_balance = account_statement.last_balance
-    min_balance = account_statement.last_balance
-    min_balance_date = account_statement.last_date
-    max_balance = account_statement.last_balance
-    max_balance_date = account_statement.last_date
-
-    while current_date >= min_date:
-        if current_date in account_statement.operations:
-            for operation in account_statement.operations[current_date]:
-                current_balance = current_balance - operation.value
-        balance_over_time[current_date] = current_balance
-
-        if current_balance < min_balance:
-            min_balance = current_balance
-            min_balance_date = current_date
-        if current_balance > max_balance:
-            max_balance = current_balance
-            max_balance_date = current_date
-
-        current_date = current_date - datetime.timedelta(days=1)
-
-    balance_debug(debug_mode, account_statement, balance_over_time)
-    balance_health_check(account_statement, balance_over_time, connection)
-
-    return (balance_over_time,
-            min_date, account_statement.last_date,
+    last_date = account_statement.last_date
+    last_balance = account_statement.last_balance
+    min_balance = last_balance
+    min_balance_date = last_date
+    max_balance = last_balance
+    max_balance_date = last_date
+
+    # daily operations totals, indexed by number of days before the last date
+    last_ordinal = last_date.toordinal()
+    days_count = max(last_ordinal - min_date.toordinal() + 1, 0)
+    operations_ordinals, amounts = account_statement.operations_arrays()
+    day_indexes = last_ordinal - operations_ordinals
+    in_range = (day_indexes >= 0) & (day_indexes < days_count)
+    deltas = np.bincount(day_indexes[in_range], weights=amounts[in_range], minlength=days_count)
+    balances = last_balance - np.cumsum(deltas)
+
+    if days_count > 0:
+        min_index = int(np.argmin(balances))
+        if balances[min_index] < min_balance:
+            min_balance = float(balances[min_index])
+            min_balance_date = last_date.fromordinal(last_ordinal - min_index)
+        max_index = int(np.argmax(balances))
+        if balances[max_index] > max_balance:
+            max_balance = float(balances[max_index])
+            max_balance_date = last_date.fromordinal(last_ordinal - max_index)
+
+    # one balance per day, in ascending date order
+    ordinals = np.arange(last_ordinal - days_count + 1, last_ordinal + 1)
+    balances = balances[::-1]
+
+    balance_debug(debug_mode, account_statement, ordinals, balances)
+    balance_health_check(account_statement, ordinals, balances, cur)
+
+    return (ordinals, balances,
+            min_date, last_date,
             min_balance, min_balance_date,
             max_balance, max_balance_date)
 
 
-def compute_savings_derivative(balance_over_time):
+def compute_savings_derivative(ordinals, balances):
     savings_derivative = {}
-    timestamps = list(balance_over_time.keys())
-    first_timestamp = timestamps[len(timestamps)-1]
-    first_month = first_timestamp.replace(day=PAY_DAY, hour=0, minute=0, second=0, microsecond=0)
-    last_timestamp = timestamps[0]
-    timespan = dateutil.relativedelta.relativedelta(last_timestamp, first_month)
-    months_list = [first_month + dateutil.relativedelta.relativedelta(months=x)
-                     for x in range(0, timespan.years*12 + timespan.months + 1)]
+    first_ordinal = int(ordinals[0])
+    first_timestamp = datetime.datetime.fromordinal(first_ordinal)
+    first_month = first_timestamp.replace(day=PAY_DAY)
+    last_timestamp = datetime.datetime.fromordinal(int(ordinals[-1]))
+    # whole months from the first pay day up to the last timestamp
+    first_month_index = first_month.year * MONTHS_IN_YEAR + first_month.month - 1
+    last_month_index = last_timestamp.year * MONTHS_IN_YEAR + last_timestamp.month - 1
+    months_count = max(last_month_index - first_month_index -
+                       (1 if last_timestamp.day < PAY_DAY else 0), 0) + 1
+    months_list = [first_month.replace(year=month_index // MONTHS_IN_YEAR, month=month_index % MONTHS_IN_YEAR + 1)
+                   for month_index in range(first_month_index, first_month_index + months_count)]
     if first_timestamp < months_list[0]:
         months_list.insert(0, first_timestamp)
     if last_timestamp > months_list[len(months_list) - 1]:
         months_list.append(last_timestamp)
-    previous_timestamp = None
+    days_count = len(balances)
+    previous_index = None
 
     for timestamp in months_list:
-        if (previous_timestamp is not None and
-                timestamp in balance_over_time and
-                previous_timestamp in balance_over_time):
+        index = timestamp.toordinal() - first_ordinal
+        if (previous_index is not None and
+                0 <= index < days_count and
+                0 <= previous_index < days_count):
             add_days = 15 if timestamp == last_timestamp and timestamp.day > PAY_DAY else 0
-            display_month = (timestamp + dateutil.relativedelta.relativedelta(days=add_days)).replace(day=1)
-            _, month_size = calendar.monthrange(timestamp.year, display_month.month)
+            display_month = (timestamp + datetime.timedelta(days=add_days)).replace(day=1)
+            _, month_size = month_range(timestamp.year, display_month.month)
             display_date = display_month.replace(day=int(month_size/2)+1)
-            savings_derivative[display_date] = balance_over_time[timestamp] - balance_over_time[previous_timestamp]
-        previous_timestamp = timestamp
+            savings_derivative[display_date] = float(balances[index] - balances[previous_index])
+        previous_index = index
 
     return savings_derivative
 
 
-def check_balance_in_checkpoints(date, expected_balance, expected_transaction_count, cur):
-    cur.execute("SELECT * FROM CHECKPOINTS WHERE DATE_EPOCH = ?", (date.strftime('%s'),))
-    row = cur.fetchone()
-    if row is None:
+def read_checkpoints_from_database(min_epoch: int, max_epoch: int, cur):
+    cur.execute("SELECT DATE_EPOCH, BALANCE, TRANSACTIONS_COUNT FROM CHECKPOINTS WHERE DATE_EPOCH BETWEEN ? AND ?",
+                (min_epoch, max_epoch))
+    return {int(row[0]): (float(row[1]), row[2]) for row in cur}
+
+
+def check_balance_in_checkpoints(date, expected_balance, expected_transaction_count, checkpoint):
+    if checkpoint is None:
         return True, None
     else:
-        checked_balance = float(row[2])
-        checked_transaction_count = row[3]
+        checked_balance, checked_transaction_count = checkpoint
         eq_balance = abs(checked_balance - expected_balance) <= 0.00001
         eq_transaction_count = (checked_transaction_count is not None and (int(checked_transaction_count) == expected_transaction_count)) or checked_transaction_count is None
         lt_transaction_count =  checked_transaction_count is not None and (int(checked_transaction_count) < expected_transaction_count)
@@ -312,85 +359,106 @@ def check_balance_in_checkpoints(date, expected_balance, expected_transaction_co
         return (eq_transaction_count and eq_balance) or lt_transaction_count, checked_balance
 
 
-def balance_health_check(acc_statement: AccountStatement, balance_over_time, connection):
+def balance_health_check(acc_statement: AccountHistory, ordinals, balances, cur):
     print("Healthcheck for balance evolution of account " +
           str(acc_statement.account_id) + " - " + get_account_name(acc_statement.account_id))
-    cur = connection.cursor()
-    for date in balance_over_time:
-        transaction_count = acc_statement.operations_count(date - datetime.timedelta(days=1))
-        coherent_with_checkpoint, previous_balance = check_balance_in_checkpoints(date, balance_over_time[date], transaction_count, cur)
+    if len(ordinals) == 0:
+        print('\033[92m' + "OK" + '\033[0m')
+        return
+    first_ordinal = int(ordinals[0])
+    checkpoints = read_checkpoints_from_database(to_epoch(datetime.datetime.fromordinal(first_ordinal)),
+                                                 to_epoch(datetime.datetime.fromordinal(int(ordinals[-1]))), cur)
+    # only checkpoints stored at the local midnight of a day can mismatch, latest first
+    for epoch in sorted(checkpoints, reverse=True):
+        ordinal = datetime.date.fromtimestamp(epoch).toordinal()
+        date = datetime.datetime.fromordinal(ordinal)
+        if to_epoch(date) != epoch:
+            continue
+        balance = float(balances[ordinal - first_ordinal])
+        transaction_count = acc_statement.operations_count(ordinal - 1)
+        coherent_with_checkpoint, previous_balance = check_balance_in_checkpoints(date, balance, transaction_count,
+                                                                                  checkpoints[epoch])
         if not coherent_with_checkpoint:
-            print('\033[93m' + date.strftime("%d/%m/%Y") + ": " + str(balance_over_time[date]) +
-                  ": balance does not match previous checkpoint " + str(previous_balance) + '\033[0m')
+            print(f"\033[93m{date:%d/%m/%Y}: {balance}: "
+                  f"balance does not match previous checkpoint {previous_balance}\033[0m")
             raise ValueError("Invalid balance in checkpoints")
     print('\033[92m' + "OK" + '\033[0m')
 
 
-def balance_debug(debug_mode: bool, acc_statement: AccountStatement, balance_over_time):
+def balance_debug(debug_mode: bool, acc_statement: AccountHistory, ordinals, balances):
     if debug_mode:
         print("Balance for account " + str(acc_statement.account_id) + " - " + get_account_name(
             acc_statement.account_id), )
-        for date in balance_over_time:
-            print(date.strftime("%d/%m/%Y") + ": " + str(balance_over_time[date]))
+        sys.stdout.write("".join(f"{datetime.date.fromordinal(ordinal):%d/%m/%Y}: {balance}\n"
+                                 for ordinal, balance in zip(ordinals[::-1].tolist(), balances[::-1].tolist())))
+
 
+def first_day_of_next_month(date):
+    if date.month == MONTHS_IN_YEAR:
+        return date.replace(year=date.year + 1, month=1, day=1)
+    return date.replace(month=date.month + 1, day=1)
 
-def calculate_month_difference(last_date, current_date):
-    difference = dateutil.relativedelta.relativedelta(last_date, current_date.replace(day=1))
-    return difference.months + MONTHS_IN_YEAR * difference.years
 
+@functools.lru_cache(maxsize=None)
+def month_range(year, month):
+    return calendar.monthrange(year, month)
 
-def compute_balance_compared(balance, last_date):
-    balance_compared = []
-    for balance_date in (balance.keys()):
-        month_diff = calculate_month_difference(last_date, balance_date)
-        while len(balance_compared) <= month_diff:
-            balance_compared.append([None] * (DAYS_IN_MONTH + 1))
-        line = balance_compared[month_diff]
-        line[balance_date.day] = balance[balance_date]
+
+def compute_balance_compared(ordinals, balances, last_date):
+    dates = to_datetime64(ordinals)
+    months = dates.astype('datetime64[M]')
+    month_diffs = (np.datetime64(last_date, 'M') - months).astype(np.int64)
+    days = (dates - months).astype(np.int64) + 1
+    balance_compared = np.full((month_diffs.max(initial=-1) + 1, DAYS_IN_MONTH + 1), np.nan)
+    balance_compared[month_diffs, days] = balances
     return balance_compared
 
 
 def write_operations_in_database(history, connection):
-    for opDate in history.operations:
-        for op in history.operations[opDate]:
-            request = "INSERT INTO TRANSACTIONS (ID, DATE, DATE_EPOCH, LABEL, AMOUNT) \
-                VALUES (" + str(op.id) + ", '" + op.date.strftime("%d/%m/%Y") + "', " + op.date.strftime(
-                '%s') + ", '" + op.label + "', " + str(op.value) + " )" \
-             + " ON CONFLICT(ID) DO NOTHING"
-            connection.execute(request)
-    connection.commit()
+    rows = ((op.id, op.date.strftime("%d/%m/%Y"), op.date_epoch, op.label, float(op.value))
+            for operations in history.operations.values() for op in operations)
+    with connection:
+        connection.executemany("INSERT INTO TRANSACTIONS (ID, DATE, DATE_EPOCH, LABEL, AMOUNT) "
+                               "VALUES (?, ?, ?, ?, ?) ON CONFLICT(ID) DO NOTHING", rows)
 
 
-def search_operations_in_database(history, connection):
+def search_operations_in_database(history, cur):
     print("Searching operations in database for account " + str(history.account_id) + " (" + get_account_name(
         history.account_id) + ")")
-    cur = connection.cursor()
-    for opDate in history.operations:
-        for op in history.operations[opDate]:
-            request = "SELECT * FROM TRANSACTIONS WHERE ID =" + str(op.id)
-            cur.execute(request)
-            row = cur.fetchone()
-            if row is None:
-                print("Operation " + str(op.id) + " is new: " + op.debug())
+    operations = [op for ops in history.operations.values() for op in ops]
+    operations_ids = [int(op.id) for op in operations if op.id is not None]
+    existing_ids = set()
+    for start in range(0, len(operations_ids), SQL_PARAMETERS_CHUNK_SIZE):
+        chunk = operations_ids[start:start + SQL_PARAMETERS_CHUNK_SIZE]
+        cur.execute("SELECT ID FROM TRANSACTIONS WHERE ID IN (" + ", ".join("?" * len(chunk)) + ")", chunk)
+        existing_ids.update(row[0] for row in cur)
+    for op in operations:
+        if op.id is None or int(op.id) not in existing_ids:
+            print("Operation " + str(op.id) + " is new: " + op.debug(False))
     print()
 
 
-def read_transactions_from_database(account_id, connection):
-    account_statement = AccountStatement(account_id)
-    cursor = connection.execute("SELECT ID, DATE, DATE_EPOCH, LABEL, AMOUNT FROM TRANSACTIONS ORDER BY DATE_EPOCH DESC")
-    for row in cursor:
-        op = Operation(row[0], datetime.datetime.utcfromtimestamp(int(row[2])), row[3], float(row[4]))
-        account_statement.add(op)
-    return account_statement
+def read_transactions_from_database(account_id, cur):
+    cur.execute("SELECT DATE_EPOCH, AMOUNT FROM TRANSACTIONS")
+    rows = cur.fetchall()
+    epochs = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    amounts = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+    # dates of the UTC epochs, as ordinals
+    return AccountHistory(account_id, epochs // SECONDS_IN_DAY + EPOCH_ORDINAL, amounts)
 
 
 def open_database_connection(account_id: int):
-    return sqlite3.connect('db/account_' + str(account_id) + '.db')
+    connection = sqlite3.connect('db/account_' + str(account_id) + '.db')
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA temp_store=MEMORY")
+    connection.execute("PRAGMA cache_size=-65536")
+    return connection
 
 
-def parse_file(filename: str, csv_output_mode: bool):
+def parse_file(filename: str, debug_mode: bool, csv_output_mode: bool):
     if filename.endswith("ofx"):
-        return parse_ofx(filename, csv_output_mode)
+        return parse_ofx(filename, debug_mode, csv_output_mode)
     elif filename.endswith("csv"):
         return parse_csv(filename)
     else:
@@ -401,21 +469,36 @@ def extract_savings(account_id: int, connection, tag: str):
     savings = 0
     if is_savings_account(account_id):
         request = ("select (select BALANCE from main.CHECKPOINTS order by DATE_EPOCH DESC LIMIT 1) - "
-                   "(select sum(amount) from main.TRANSACTIONS where TAG = '") + tag + "') AS AVAILABLE"
+                   "(select sum(amount) from main.TRANSACTIONS where TAG = ?) AS AVAILABLE")
         cur = connection.cursor()
-        cur.execute(request)
+        cur.execute(request, (tag,))
         row = cur.fetchone()
         savings = row[0] if row and row[0] else 0
     return savings
 
 
-def process_statements(new_account_statements: [AccountStatement], dry_run_mode: bool, debug_mode: bool, tag: str):
+def process_statements(new_account_statements: [AccountStatement], dry_run_mode: bool, debug_mode: bool, tag: str,
+                       plots_dir: str = None):
     savings = {}
-    for new_account_statement in new_account_statements:
-        with open_database_connection(new_account_statement.account_id) as connection:
-            prepare_and_analyse_history(new_account_statement, connection, dry_run_mode, debug_mode)
-            if is_savings_account(new_account_statement.account_id):
-                savings[new_account_statement.account_id] = extract_savings(new_account_statement.account_id, connection, tag)
+    connections = {}
+    try:
+        for new_account_statement in new_account_statements:
+            account_id = new_account_statement.account_id
+            connection = connections.get(account_id)
+            if connection is None:
+                connection = connections[account_id] = open_database_connection(account_id)
+            with connection:
+                prepare_and_analyse_history(new_account_statement, connection, dry_run_mode, debug_mode, plots_dir)
+                if is_savings_account(account_id):
+                    savings[account_id] = extract_savings(account_id, connection, tag)
+    finally:
+        for connection in connections.values():
+            try:
+                connection.execute("PRAGMA optimize")
+            except sqlite3.Error as e:
+                print("Failed to optimize database:", str(e))
+            finally:
+                connection.close()
     report_savings(savings)
 
 
@@ -428,53 +511,55 @@ def report_savings(savings):
     print('\n' + '\033[33m' + "Total savings: " + format_amount(total_savings) + '\033[0m')
 
 
-def prepare_and_analyse_history(new_statements: AccountStatement, connection, dry_run_mode: bool, debug_mode: bool):
+def prepare_and_analyse_history(new_statements: AccountStatement, connection, dry_run_mode: bool, debug_mode: bool,
+                                plots_dir: str = None):
     create_transactions_table_if_not_exists(connection)
     create_checkpoints_table_if_not_exists(connection)
-    if dry_run_mode:
-        search_operations_in_database(new_statements, connection)
-    else:
-        write_operations_in_database(new_statements, connection)
-        whole_statements = read_transactions_from_database(new_statements.account_id, connection)
-        update_statements_details(new_statements, whole_statements)
-        try:
-            analyse_operations(whole_statements, connection, debug_mode)
-            last_date_transactions_count = get_last_date_transactions_count(whole_statements, connection)
-            update_checkpoints(whole_statements, last_date_transactions_count, connection)
-        except ValueError as e:
-            print('\033[91m' + "Error in analyse operations for account " + str(new_statements.account_id) +
-                  " - " + get_account_name(new_statements.account_id) + ": " + str(e) + '\033[0m')
+    cur = connection.cursor()
+    try:
+        if dry_run_mode:
+            search_operations_in_database(new_statements, cur)
+        else:
+            write_operations_in_database(new_statements, connection)
+            whole_statements = read_transactions_from_database(new_statements.account_id, cur)
+            update_statements_details(new_statements, whole_statements)
+            try:
+                analyse_operations(whole_statements, cur, debug_mode, plots_dir)
+                last_date_transactions_count = get_last_date_transactions_count(whole_statements, cur)
+                update_checkpoints(whole_statements, last_date_transactions_count, connection)
+            except ValueError as e:
+                print('\033[91m' + "Error in analyse operations for account " + str(new_statements.account_id) +
+                      " - " + get_account_name(new_statements.account_id) + ": " + str(e) + '\033[0m')
+    finally:
+        cur.close()
 
 
-def update_statements_details(new_history: AccountStatement, whole_history: AccountStatement):
+def update_statements_details(new_history: AccountStatement, whole_history: AccountHistory):
     whole_history.last_date = new_history.last_date
     whole_history.last_balance = new_history.last_balance
 
-def get_last_date_transactions_count(acc_statement: AccountStatement, connection):
-    request = ("SELECT COUNT(ID) FROM TRANSACTIONS WHERE DATE_EPOCH= " + acc_statement.last_date.strftime('%s'))
-    cur = connection.cursor()
-    cur.execute(request)
+def get_last_date_transactions_count(acc_statement: AccountHistory, cur):
+    cur.execute("SELECT COUNT(ID) FROM TRANSACTIONS WHERE DATE_EPOCH = ?", (to_epoch(acc_statement.last_date),))
     row = cur.fetchone()
     count = row[0] if row and row[0] else 0
     return count
 
-def update_checkpoints(acc_statement: AccountStatement, last_date_transactions_count: int, connection):
+def update_checkpoints(acc_statement: AccountHistory, last_date_transactions_count: int, connection):
     last_balance = acc_statement.last_balance
     last_date = acc_statement.last_date
-    request = ("INSERT INTO CHECKPOINTS (DATE_EPOCH, DATE, BALANCE, TRANSACTIONS_COUNT) VALUES \
-               (" + last_date.strftime('%s') + ", '" + last_date.strftime("%d/%m/%Y") + "', "
-                + str(last_balance) + ", " + str(last_date_transactions_count) + " )" \
-                + " ON CONFLICT(DATE_EPOCH) DO NOTHING")
-    connection.execute(request)
-    connection.commit()
+    with connection:
+        connection.execute("INSERT INTO CHECKPOINTS (DATE_EPOCH, DATE, BALANCE, TRANSACTIONS_COUNT) "
+                           "VALUES (?, ?, ?, ?) ON CONFLICT(DATE_EPOCH) DO NOTHING",
+                           (to_epoch(last_date), last_date.strftime("%d/%m/%Y"), last_balance,
+                            last_date_transactions_count))
 
 
-def main(filename: str, dry_run_mode: bool, debug_mode: bool, csv_output_mode: bool, tag: str):
-    new_account_statements = parse_file(filename, csv_output_mode)
-    process_statements(new_account_statements, dry_run_mode, debug_mode, tag)
+def main(filename: str, dry_run_mode: bool, debug_mode: bool, csv_output_mode: bool, tag: str, plots_dir: str = None):
+    new_account_statements = parse_file(filename, debug_mode, csv_output_mode)
+    process_statements(new_account_statements, dry_run_mode, debug_mode, tag, plots_dir)
 
 
-def parse_ofx(filename: str, csv_output_mode: bool):
+def parse_ofx(filename: str, debug_mode: bool, csv_output_mode: bool):
     parsed_account_statements = []
     with open(filename, 'r', encoding="cp1252") as ofxFile:
         ofx = OfxParser.parse(ofxFile)
@@ -491,13 +576,17 @@ def parse_ofx(filename: str, csv_output_mode: bool):
                 print("WARNING: No transaction in this file for account " + str(account.account_id) +
                       " - " + get_account_name(account.account_id))
             else:
+                operations_debug = []
+                add_operation = account_statement.add
                 for transaction in statement.transactions:
                     operation = Operation(transaction.id,
                                           transaction.date,
                                           transaction.memo,
                                           transaction.amount)
-                    print(operation.debug(csv_output_mode))
-                    account_statement.add(operation)
+                    if debug_mode or csv_output_mode:
+                        operations_debug.append(operation.debug(csv_output_mode) + "\n")
+                    add_operation(operation)
+                sys.stdout.write("".join(operations_debug))
             parsed_account_statements.append(account_statement)
 
     print()
@@ -509,22 +598,21 @@ def parse_csv(filename: str):
     account_statement = AccountStatement(0)
     with open(filename, 'r', encoding="ISO 8859-1") as csvFile:
         account_reader = csv.reader(csvFile, delimiter=';', quotechar='"')
-        pattern_last_balance = re.compile(r'Solde au ([0-3][0-9]\/[0-1][0-9]\/[1-2][0-9]{3}) ([\d+\xa0]*\d+,\d\d) \x80')
-        pattern_operation = re.compile(r'[0-3][0-9]\/[0-1][0-9]\/[1-2][0-9]{3}')
+        add_operation = account_statement.add
         for row in account_reader:
-            if len(row) == 1:
-                match_last_balance = pattern_last_balance.match(row[0])
+            if len(row) == 1 and row[0].startswith("Solde au "):
+                match_last_balance = PATTERN_LAST_BALANCE.match(row[0])
                 if match_last_balance:
-                    account_statement.last_balance = float(match_last_balance.group(2).replace(',', '.').replace('\xa0', ''))
-                    account_statement.last_date = datetime.datetime.strptime(match_last_balance.group(1), '%d/%m/%Y').date()
-            if len(row) >= 4:
-                match_operation = pattern_operation.match(row[0])
+                    account_statement.last_balance = parse_double(match_last_balance.group(2))
+                    account_statement.last_date = parse_date(match_last_balance.group(1))
+            elif len(row) >= 4 and row[0][2:3] == '/' and row[0][5:6] == '/':
+                match_operation = PATTERN_OPERATION.match(row[0])
                 if match_operation:
-                    transaction_date = datetime.datetime.strptime(row[0], '%d/%m/%Y').date()
+                    transaction_date = parse_date(row[0])
                     debit = parse_double(row[2])
                     credit = parse_double(row[3])
                     transaction_amount = -debit if debit > 0.0 else credit
-                    account_statement.add(Operation(None, transaction_date, row[1], transaction_amount))
+                    add_operation(Operation(None, transaction_date, row[1], transaction_amount))
     parsed_account_statements.append(account_statement)
     return parsed_account_statements
 
@@ -537,6 +625,7 @@ def create_transactions_table_if_not_exists(connection):
          LABEL          TEXT,
          AMOUNT         REAL,
          TAG            TEXT);''')
+    connection.execute("CREATE INDEX IF NOT EXISTS IDX_TRANSACTIONS_DATE_EPOCH ON TRANSACTIONS (DATE_EPOCH)")
 
 
 def create_checkpoints_table_if_not_exists(connection):
@@ -552,24 +641,28 @@ def print_usage_and_exit():
     exit(1)
 
 
-def process_import(filename: str, dry_run_mode: bool, debug_mode: bool, csv_output_mode: bool, tag: str):
-    main(filename, dry_run_mode, debug_mode, csv_output_mode, tag)
+def process_import(filename: str, dry_run_mode: bool, debug_mode: bool, csv_output_mode: bool, tag: str,
+                   plots_dir: str = None):
+    main(filename, dry_run_mode, debug_mode, csv_output_mode, tag, plots_dir)
     print()
 
 
 if __name__ == "__main__":
     if len(sys.argv) >= 3 and sys.argv[1] == IMPORT_FLAG:
-        dry_run = (len(sys.argv) >= 4 and sys.argv[3] == DRY_RUN_FLAG) or (
-                    len(sys.argv) == 5 and sys.argv[4] == DRY_RUN_FLAG)
-        debug = (len(sys.argv) >= 4 and sys.argv[3] == DEBUG_FLAG) or (
-                  len(sys.argv) == 5 and sys.argv[4] == DEBUG_FLAG)
-        csv_output = (len(sys.argv) >= 4 and sys.argv[3] == CSV_OUTPUT_FLAG) or (
-                 len(sys.argv) == 5 and sys.argv[4] == CSV_OUTPUT_FLAG)
+        flags = sys.argv[3:]
+        dry_run = DRY_RUN_FLAG in flags
+        debug = DEBUG_FLAG in flags
+        csv_output = CSV_OUTPUT_FLAG in flags
+        plots_directory = None
+        if SAVE_PLOTS_FLAG in flags:
+            plt.switch_backend("Agg")
+            os.makedirs(PLOTS_DIRECTORY, exist_ok=True)
+            plots_directory = PLOTS_DIRECTORY
 
         try:
             config.read("conf/properties.ini")
         except Exception as e:
             print("Failed to load properties configuration file:", str(e))
-        process_import(sys.argv[2], dry_run, debug, csv_output, config.get("Savings tags", "exclude"))
+        process_import(sys.argv[2], dry_run, debug, csv_output, config.get("Savings tags", "exclude"), plots_directory)
     else:
         print_usage_and_exit()